@@ -1,8 +1,17 @@
 import logging
+import logging.handlers
 import os
 import sys
+import queue
+import atexit
+import json
+import random
 import sqlite3
+import threading
+import time
 import asyncio
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -18,12 +27,17 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackQueryHandler,
-    ConversationHandler
+    ConversationHandler,
+    AIORateLimiter,
+    BaseUpdateProcessor
 )
+from telegram.request import HTTPXRequest
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -32,184 +46,360 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
+# ID администратора как число, для проверки прав без преобразования user.id в строку
+ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID and ADMIN_CHAT_ID.lstrip('-').isdigit() else None
 SPREADSHEET_URL = os.getenv('SPREADSHEET_URL')
 
+# Числовой ID канала, определяется при запуске (до этого используется @username)
+CHANNEL_ID = CHANNEL_USERNAME
+
 # Пути к изображениям
 WELCOME_IMAGE = "images/welcome.jpg"
 COUPON_IMAGE = "images/coupon.jpg"
 
+def load_images(paths):
+    """Чтение изображений в память один раз при запуске: путь -> содержимое файла"""
+    images = {}
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as image_file:
+                images[path] = image_file.read()
+    return images
+
+# Содержимое изображений (отсутствующих файлов в словаре нет)
+IMAGES = load_images((WELCOME_IMAGE, COUPON_IMAGE))
+
+# file_id загруженных в Telegram изображений: путь -> file_id
+FILE_IDS = {}
+
+# Приветственное сообщение
+WELCOME_CAPTION = (
+    "🛠️ Добро пожаловать в <b>P.I.T Store Оренбург</b>!\n\n"
+    "🎁 <b>Получите специальный купон наааахуй</b>\n\n"
+    "Для участия в акции необходимо:\n"
+    "1️⃣ Подписаться на наш канал\n"
+    "2️⃣ Поделиться номером телефона\n\n"
+    "После этого вы получите персональный купон для использования в нашем магазине!"
+)
+
+# Текст сообщения с купоном, подставляется только код купона
+COUPON_CAPTION = (
+    "🎉 <b>Благодарим за участие!</b>\n\n"
+    "🏷️ <b>Ваш купон на штучку дрючку:</b> <code>{coupon}</code>\n\n"
+    "🎁 <b>Что вы получаете:</b>\n"
+    "• Скидку 100% на любой инструмент\n"
+    "• Подарочный набор расходных материалов\n"
+    "• Бесплатную консультацию Коли\n\n"
+    "🏪 <b>Адрес магазина:</b>\n"
+    "г. Оренбург, ул. Монтажников 37/3\n\n"
+    "📞 <b>Телефон для связи:</b> +7 (495) 123-45-67\n\n"
+    "<i>Купон действует в течение 15 дней</i>"
+)
+
+# Клавиатуры не меняются, поэтому создаются один раз
+SUBSCRIBE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 Подписаться на канал", url=f"https://t.me/{(CHANNEL_USERNAME or '')[1:]}")],
+    [InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")]
+])
+CONTACT_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📞 Поделиться номером", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+BROADCAST_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    ["📢 Текстовая рассылка"],
+    ["🖼️ Рассылка с фото"],
+    ["❌ Отмена"]
+], resize_keyboard=True, one_time_keyboard=True)
+BROADCAST_CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Начать рассылку", callback_data="confirm_broadcast")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_broadcast")]
+])
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
 # Состояния для рассылки
 BROADCAST_TEXT, BROADCAST_PHOTO = range(2)
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Рассылка: число одновременных отправок (темп, 25 сообщений/с, задает AIORateLimiter)
+# и период обновления статистики для администратора, в секундах
+BROADCAST_CONCURRENCY = 30
+BROADCAST_PROGRESS_INTERVAL = 10
+
+# Фоновая пакетная запись в SQLite и Google Sheets. Таблица пишется реже:
+# квота Sheets на запись - 60 запросов в минуту, то есть не чаще раза в секунду
+FLUSH_INTERVAL = 1.0
+SHEETS_FLUSH_INTERVAL = 5.0
+SHEETS_BATCH_SIZE = 100
+
+# Повтор записи в Google Sheets при превышении квоты и ошибках сервера;
+# строки, которые так и не удалось записать, сохраняются в БД и повторяются раз в минуту
+SHEETS_MAX_ATTEMPTS = 5
+SHEETS_RETRY_STATUSES = (429, 500, 502, 503)
+SHEETS_OUTBOX_RETRY_INTERVAL = 60
+
+# Период принудительного checkpoint WAL-журнала SQLite, в секундах
+WAL_CHECKPOINT_INTERVAL = 600
+
+# Токен Google обновляется заранее, чтобы не делать этого при записи в таблицу
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+INSERT_USER_SQL = '''
+    INSERT OR IGNORE INTO users (user_id, phone, username, first_name, registered_at, coupon_code)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Кэш проверки подписки: user_id -> (момент истечения, статус в канале).
+# Отрицательный результат живет меньше, чтобы после подписки можно было быстро повторить проверку
+SUBSCRIPTION_CACHE = {}
+SUBSCRIPTION_CACHE_TTL = 60
+SUBSCRIPTION_CACHE_NEGATIVE_TTL = 10
+SUBSCRIPTION_CACHE_MAXSIZE = 10000
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+# Настройка логирования: обработчики только кладут записи в очередь,
+# а вывод в stderr выполняет отдельный поток, чтобы не блокировать event loop
+log_queue = queue.Queue(-1)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+# Форматирует только StreamHandler в потоке слушателя; basicConfig не используется,
+# иначе QueueHandler получил бы свой форматтер и сообщение форматировалось бы дважды
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 class UserManager:
     def __init__(self):
         self.db_path = '/root/pitbot/users.db'
+        # Одно постоянное соединение на все запросы, доступ к нему под блокировкой
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        # Кэш зарегистрированных пользователей: user_id -> купон
+        self._users = {}
+        # Занятые номера телефонов: phone -> user_id (в таблице phone UNIQUE)
+        self._phones = {}
+        # Новые пользователи, еще не записанные в БД
+        self._pending = []
+        self._pending_lock = threading.Lock()
         self.setup_database()
     
-    def get_connection(self):
+    def connect(self):
         """Создание соединения с базой данных"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            # isolation_level=None: транзакции открываются явно в transaction()
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
             conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA cache_size = -64000")
+            conn.execute("PRAGMA mmap_size = 134217728")
             return conn
         except Exception as e:
-            logging.error(f"❌ Ошибка подключения к БД: {e}")
-            return None
+            logging.error("❌ Ошибка подключения к БД: %s", e)
+            raise
+    
+    @contextmanager
+    def get_connection(self):
+        """Постоянное соединение с базой данных (открывается при первом обращении)"""
+        with self._conn_lock:
+            if self._conn is None:
+                self._conn = self.connect()
+            yield self._conn
+    
+    @contextmanager
+    def transaction(self):
+        """Явная транзакция BEGIN IMMEDIATE ... COMMIT на постоянном соединении"""
+        with self.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                # Не оставляем постоянное соединение внутри открытой транзакции
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
     
     def setup_database(self):
         """Создание базы данных для отслеживания пользователей"""
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return
-            
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    phone TEXT UNIQUE,
-                    username TEXT,
-                    first_name TEXT,
-                    registered_at TIMESTAMP,
-                    coupon_code TEXT
-                )
-            ''')
-            conn.commit()
-            conn.close()
-            logging.info("✅ База данных пользователей инициализирована")
+            with self.transaction() as conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        phone TEXT UNIQUE,
+                        username TEXT,
+                        first_name TEXT,
+                        registered_at TIMESTAMP,
+                        coupon_code TEXT
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS pending_sheets_rows (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        row_data TEXT
+                    )
+                ''')
+                for user_id, phone, coupon_code in conn.execute('SELECT user_id, phone, coupon_code FROM users'):
+                    self._users[user_id] = coupon_code
+                    if phone:
+                        self._phones[phone] = user_id
+            logging.info("✅ База данных пользователей инициализирована. Пользователей: %s", len(self._users))
         except Exception as e:
-            logging.error(f"❌ Ошибка инициализации базы данных: {e}")
+            # Без загруженного списка участников нельзя проверять повторную регистрацию
+            # и сохранять новых пользователей, поэтому запуск прерывается
+            logging.error("❌ Ошибка инициализации базы данных: %s", e)
+            raise
     
-    def is_user_registered(self, user_id):
-        """Проверка, регистрировался ли пользователь ранее"""
+    def get_user_state(self, user_id):
+        """Проверка регистрации и купон пользователя: (зарегистрирован ли, купон)"""
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return False
-                
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone() is not None
-            conn.close()
-            return result
-        except Exception as e:
-            logging.error(f"❌ Ошибка проверки пользователя {user_id}: {e}")
-            return False
+            return True, self._users[user_id]
+        except KeyError:
+            return False, None
+    
+    @staticmethod
+    def _user_row(user_data):
+        """Строка для INSERT_USER_SQL из данных пользователя"""
+        return (
+            user_data['user_id'],
+            user_data['phone'],
+            user_data.get('username', ''),
+            user_data.get('first_name', ''),
+            user_data.get('registered_at') or datetime.now(),
+            user_data.get('coupon', '')
+        )
     
     def register_user(self, user_data):
-        """Регистрация нового пользователя"""
-        conn = None
+        """Регистрация пользователя, если его еще нет: возвращает (новый ли пользователь, купон).
+        
+        Если номер телефона уже занят другим пользователем, возвращает (False, None).
+        """
+        row = self._user_row(user_data)
+        with self._pending_lock:
+            if user_data['user_id'] in self._users:
+                return False, self._users[user_data['user_id']]
+            # Конфликт по phone решается здесь, чтобы кэш не расходился с таблицей
+            if user_data['phone'] in self._phones:
+                return False, None
+            self._pending.append(row)
+            self._users[user_data['user_id']] = user_data.get('coupon', '')
+            self._phones[user_data['phone']] = user_data['user_id']
+        logging.info("✅ Пользователь %s зарегистрирован", user_data['user_id'])
+        return True, user_data.get('coupon', '')
+    
+    def flush_pending(self):
+        """Пакетная запись новых пользователей в БД"""
+        with self._pending_lock:
+            rows, self._pending = self._pending, []
+        if not rows:
+            return 0
+        
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return False
-                
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, phone, username, first_name, registered_at, coupon_code)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user_data['user_id'],
-                user_data['phone'],
-                user_data.get('username', ''),
-                user_data.get('first_name', ''),
-                datetime.now(),
-                user_data.get('coupon', '')
-            ))
-            conn.commit()
-            conn.close()
-            logging.info(f"✅ Пользователь {user_data['user_id']} зарегистрирован в локальной БД")
-            return True
-        except sqlite3.IntegrityError as e:
-            logging.warning(f"⚠️ Ошибка целостности данных для пользователя {user_data['user_id']}: {e}")
-            # Пробуем обновить существующую запись
-            try:
-                if conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        UPDATE users SET 
-                        phone = ?, username = ?, first_name = ?, registered_at = ?, coupon_code = ?
-                        WHERE user_id = ?
-                    ''', (
-                        user_data['phone'],
-                        user_data.get('username', ''),
-                        user_data.get('first_name', ''),
-                        datetime.now(),
-                        user_data.get('coupon', ''),
-                        user_data['user_id']
-                    ))
-                    conn.commit()
-                    conn.close()
-                    logging.info(f"✅ Данные пользователя {user_data['user_id']} обновлены")
-                    return True
-            except Exception as update_error:
-                logging.error(f"❌ Ошибка обновления пользователя {user_data['user_id']}: {update_error}")
-                return False
+            with self.transaction() as conn:
+                conn.executemany(INSERT_USER_SQL, rows)
+            logging.info("✅ В локальную БД записано пользователей: %s", len(rows))
+            return len(rows)
         except Exception as e:
-            logging.error(f"❌ Ошибка регистрации пользователя {user_data['user_id']}: {e}")
-            if conn:
-                conn.close()
-            return False
+            logging.error("❌ Ошибка записи пользователей в БД: %s", e)
+            # Возвращаем строки в буфер для следующей попытки
+            with self._pending_lock:
+                self._pending[:0] = rows
+            return 0
     
-    def get_user_coupon(self, user_id):
-        """Получение купона пользователя"""
+    def register_users_bulk(self, users_data):
+        """Массовая регистрация пользователей одной транзакцией: возвращает число добавленных.
+        
+        В боте не вызывается; предназначена для импорта и переноса данных из скриптов.
+        Уже известные user_id и занятые номера пропускаются, registered_at берется из данных.
+        При ошибке записи исключение пробрасывается, а пользователи не считаются зарегистрированными.
+        """
+        rows = []
+        with self._pending_lock:
+            for user_data in users_data:
+                if user_data['user_id'] in self._users or user_data['phone'] in self._phones:
+                    continue
+                rows.append(self._user_row(user_data))
+                self._users[user_data['user_id']] = user_data.get('coupon', '')
+                self._phones[user_data['phone']] = user_data['user_id']
+        if not rows:
+            return 0
+        
+        # Пишем сразу, а не через буфер: у скрипта импорта нет фоновой записи,
+        # и строки, оставшиеся в буфере после ошибки, пропали бы при выходе
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return None
-                
-            cursor = conn.cursor()
-            cursor.execute('SELECT coupon_code FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result[0] if result else None
+            with self.transaction() as conn:
+                conn.executemany(INSERT_USER_SQL, rows)
         except Exception as e:
-            logging.error(f"❌ Ошибка получения купона для {user_id}: {e}")
-            return None
+            logging.error("❌ Ошибка массовой регистрации пользователей: %s", e)
+            with self._pending_lock:
+                for row in rows:
+                    self._users.pop(row[0], None)
+                    self._phones.pop(row[1], None)
+            raise
+        logging.info("✅ Массово зарегистрировано пользователей: %s", len(rows))
+        return len(rows)
     
-    def get_stats(self):
-        """Получение статистики"""
+    def checkpoint(self):
+        """Перенос WAL в основной файл БД и усечение журнала"""
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return 0
-                
-            cursor = conn.cursor()
-            cursor.execute('SELECT COUNT(*) FROM users')
-            total_users = cursor.fetchone()[0]
-            conn.close()
-            return total_users
+            with self.get_connection() as conn:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
         except Exception as e:
-            logging.error(f"❌ Ошибка получения статистики: {e}")
-            return 0
+            logging.error("❌ Ошибка checkpoint WAL: %s", e)
     
-    def get_all_users(self):
-        """Получение списка всех пользователей"""
+    def save_outbox_rows(self, rows):
+        """Сохранение строк, не записанных в Google Sheets, для повторной попытки"""
         try:
-            conn = self.get_connection()
-            if conn is None:
-                return []
-                
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM users')
-            users = cursor.fetchall()
-            conn.close()
-            return [user[0] for user in users]
+            with self.transaction() as conn:
+                conn.executemany(
+                    'INSERT INTO pending_sheets_rows (row_data) VALUES (?)',
+                    [(json.dumps(row, ensure_ascii=False),) for row in rows]
+                )
+            logging.warning("⚠️ Отложено строк для повторной записи в таблицу: %s", len(rows))
         except Exception as e:
-            logging.error(f"❌ Ошибка получения списка пользователей: {e}")
+            logging.error("❌ Ошибка сохранения отложенных строк таблицы: %s", e)
+    
+    def get_outbox_rows(self, limit):
+        """Получение отложенных строк таблицы: список (id, строка)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.execute(
+                    'SELECT id, row_data FROM pending_sheets_rows ORDER BY id LIMIT ?', (limit,)
+                )
+                return [(row_id, json.loads(row_data)) for row_id, row_data in cursor]
+        except Exception as e:
+            logging.error("❌ Ошибка чтения отложенных строк таблицы: %s", e)
             return []
+    
+    def delete_outbox_rows(self, row_ids):
+        """Удаление записанных в таблицу отложенных строк"""
+        try:
+            with self.transaction() as conn:
+                conn.executemany('DELETE FROM pending_sheets_rows WHERE id = ?', [(row_id,) for row_id in row_ids])
+        except Exception as e:
+            logging.error("❌ Ошибка удаления отложенных строк таблицы: %s", e)
+    
+    def get_stats(self):
+        """Получение статистики"""
+        return len(self._users)
+    
+    def get_all_users(self):
+        """Получение списка всех пользователей"""
+        return list(self._users)
 
 class GoogleSheetsManager:
     def __init__(self):
+        self.creds = None
         self.client = None
         self.sheet = None
         self.is_connected = False
+        self._queue = asyncio.Queue()
         self.setup_gsheets()
     
     def setup_gsheets(self):
@@ -226,8 +416,12 @@ class GoogleSheetsManager:
                 logging.error("❌ Файл credentials.json не найден")
                 return False
                 
-            creds = Credentials.from_service_account_file('credentials.json', scopes=scope)
-            self.client = gspread.authorize(creds)
+            self.creds = Credentials.from_service_account_file('credentials.json', scopes=scope)
+            
+            # Постоянная сессия с пулом keep-alive соединений к Google API
+            session = AuthorizedSession(self.creds)
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32, pool_block=True))
+            self.client = gspread.Client(auth=self.creds, session=session)
             
             # Проверяем переменную окружения
             spreadsheet_url = os.getenv('SPREADSHEET_URL')
@@ -238,77 +432,136 @@ class GoogleSheetsManager:
             self.sheet = self.client.open_by_url(spreadsheet_url).sheet1
             
             # ПРОВЕРКА И ИНИЦИАЛИЗАЦИЯ ТАБЛИЦЫ
-            try:
-                # Пробуем прочитать данные
-                records = self.sheet.get_all_records()
-                logging.info(f"✅ Google Sheets подключен. Записей в таблице: {len(records)}")
-                
-            except IndexError:
+            # Читаем только первую строку, а не всю таблицу
+            header = self.sheet.row_values(1)
+            if not header:
                 # Если таблица пустая, создаем заголовки
                 logging.info("⚠️ Таблица пустая, создаем заголовки...")
                 headers = ["Дата", "Имя", "Фамилия", "Телефон", "Username", "User ID", "Купон"]
                 self.sheet.append_row(headers)
                 logging.info("✅ Заголовки таблицы созданы")
-                records = []
-                
-            # Если таблица пустая (нет записей кроме заголовков)
-            if len(records) == 0:
-                logging.info("📝 Таблица готова к работе, записей пока нет")
-                    
+            
+            logging.info("✅ Google Sheets подключен")
             self.is_connected = True
             return True
             
         except gspread.exceptions.SpreadsheetNotFound:
             logging.error("❌ Таблица не найдена. Проверьте SPREADSHEET_URL")
         except gspread.exceptions.APIError as e:
-            logging.error(f"❌ Ошибка доступа к API: {e}")
+            logging.error("❌ Ошибка доступа к API: %s", e)
             logging.error("Добавьте сервисный аккаунт в редакторы таблицы")
         except Exception as e:
-            logging.error(f"❌ Ошибка подключения к Google Sheets: {e}")
+            logging.error("❌ Ошибка подключения к Google Sheets: %s", e)
             import traceback
             logging.error(traceback.format_exc())
         
         return False
     
     def add_lead(self, data):
-        """Добавление лида в таблицу"""
+        """Постановка лида в очередь на запись в таблицу"""
         if not self.is_connected:
             logging.error("❌ Google Sheets не подключен, данные не сохранены")
             return False
             
+        row = [
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            data.get('first_name', ''),
+            data.get('last_name', ''),
+            data.get('phone', ''),
+            data.get('username', ''),
+            data.get('user_id', ''),
+            data.get('coupon', '')
+        ]
+        self._queue.put_nowait(row)
+        return True
+    
+    async def flush(self):
+        """Запись накопленных лидов пакетами по SHEETS_BATCH_SIZE строк; возвращает незаписанные строки"""
+        # Записываем только то, что было в очереди на момент вызова: лиды, пришедшие
+        # во время записи, ждут следующего вызова, иначе под нагрузкой цикл не завершается
+        remaining = self._queue.qsize()
+        failed_rows = []
+        while remaining:
+            rows = [self._queue.get_nowait() for _ in range(min(remaining, SHEETS_BATCH_SIZE))]
+            remaining -= len(rows)
+            if not await self.write_rows(rows):
+                failed_rows.extend(rows)
+        return failed_rows
+    
+    async def refresh_token_if_needed(self):
+        """Обновление токена доступа, если он истекает в ближайшие TOKEN_REFRESH_MARGIN"""
+        if not self.is_connected:
+            return
+        expiry = self.creds.expiry
+        if self.creds.valid and expiry and expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN:
+            return
         try:
-            row = [
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                data.get('first_name', ''),
-                data.get('last_name', ''),
-                data.get('phone', ''),
-                data.get('username', ''),
-                data.get('user_id', ''),
-                data.get('coupon', '')
-            ]
-            self.sheet.append_row(row)
-            logging.info(f"✅ Данные добавлены в таблицу: {data['first_name']} - {data['phone']}")
-            return True
+            await asyncio.to_thread(self.creds.refresh, GoogleAuthRequest())
+            logging.info("✅ Токен Google обновлен")
         except Exception as e:
-            logging.error(f"❌ Ошибка при записи в таблицу: {e}")
-            return False
+            logging.error("❌ Ошибка обновления токена Google: %s", e)
+    
+    async def write_rows(self, rows):
+        """Отправка пакета строк в таблицу одним запросом с повтором при 429/5xx"""
+        for attempt in range(SHEETS_MAX_ATTEMPTS):
+            try:
+                await asyncio.to_thread(
+                    self.sheet.append_rows,
+                    rows,
+                    value_input_option='RAW',
+                    insert_data_option='INSERT_ROWS'
+                )
+                logging.info("✅ Данные добавлены в таблицу: %s строк", len(rows))
+                return True
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if status not in SHEETS_RETRY_STATUSES or attempt == SHEETS_MAX_ATTEMPTS - 1:
+                    logging.error("❌ Ошибка при записи в таблицу (%s строк): %s", len(rows), e)
+                    return False
+                # Экспоненциальная задержка со случайной добавкой
+                delay = 2 ** attempt + random.random()
+                logging.warning("⚠️ Google Sheets ответил %s, повтор через %.1f с", status, delay)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logging.error("❌ Ошибка при записи в таблицу (%s строк): %s", len(rows), e)
+                return False
+        return False
 
 # Инициализация менеджеров
 user_manager = UserManager()
 gsheets_manager = GoogleSheetsManager()
 
+# Отдельный пул потоков для SQLite, чтобы запросы к БД не блокировали event loop
+# и не конкурировали с запросами к Google Sheets в пуле по умолчанию
+db_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='db')
+
+async def run_db(func, *args):
+    """Выполнение блокирующего запроса к БД в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, func, *args)
+
 async def send_photo_with_caption(chat_id, context, image_path, caption, reply_markup=None):
     """Универсальная функция отправки фото с текстом"""
     try:
-        if os.path.exists(image_path):
-            with open(image_path, 'rb') as photo:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=photo,
-                    caption=caption,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
+        file_id = FILE_IDS.get(image_path)
+        if file_id:
+            await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            )
+            return True
+        elif image_path in IMAGES:
+            message = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=IMAGES[image_path],
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode="HTML"
+            )
+            FILE_IDS[image_path] = message.photo[-1].file_id
             return True
         else:
             await context.bot.send_message(
@@ -317,10 +570,10 @@ async def send_photo_with_caption(chat_id, context, image_path, caption, reply_m
                 reply_markup=reply_markup,
                 parse_mode="HTML"
             )
-            logging.warning(f"⚠️ Изображение не найдено: {image_path}")
+            logging.warning("⚠️ Изображение не найдено: %s", image_path)
             return False
     except Exception as e:
-        logging.error(f"❌ Ошибка отправки фото: {e}")
+        logging.error("❌ Ошибка отправки фото: %s", e)
         await context.bot.send_message(
             chat_id=chat_id,
             text=caption,
@@ -329,25 +582,39 @@ async def send_photo_with_caption(chat_id, context, image_path, caption, reply_m
         )
         return False
 
+async def get_subscription_status(bot, user_id):
+    """Статус пользователя в канале с кэшированием на SUBSCRIPTION_CACHE_TTL секунд"""
+    now = time.monotonic()
+    cached = SUBSCRIPTION_CACHE.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+    status = member.status
+    
+    if len(SUBSCRIPTION_CACHE) >= SUBSCRIPTION_CACHE_MAXSIZE:
+        # Удаляем устаревшие записи, а если их нет - самую старую
+        expired = [uid for uid, (expires_at, _) in SUBSCRIPTION_CACHE.items() if expires_at <= now]
+        for uid in expired or [next(iter(SUBSCRIPTION_CACHE))]:
+            del SUBSCRIPTION_CACHE[uid]
+    
+    ttl = SUBSCRIPTION_CACHE_TTL if status in SUBSCRIBED_STATUSES else SUBSCRIPTION_CACHE_NEGATIVE_TTL
+    SUBSCRIPTION_CACHE[user_id] = (now + ttl, status)
+    return status
+
 # ========== РАССЫЛКА СООБЩЕНИЙ ==========
 
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало процесса рассылки"""
     user = update.effective_user
-    if str(user.id) != ADMIN_CHAT_ID:
+    if user.id != ADMIN_CHAT_ID_INT:
         await update.message.reply_text("❌ Эта команда только для администратора")
         return ConversationHandler.END
 
-    keyboard = ReplyKeyboardMarkup([
-        ["📢 Текстовая рассылка"],
-        ["🖼️ Рассылка с фото"],
-        ["❌ Отмена"]
-    ], resize_keyboard=True, one_time_keyboard=True)
-
     await update.message.reply_text(
         "📢 <b>Панель рассылки</b>\n\n"
         "Выберите тип рассылки:",
-        reply_markup=keyboard,
+        reply_markup=BROADCAST_MENU_KEYBOARD,
         parse_mode="HTML"
     )
     return BROADCAST_TEXT
@@ -355,12 +622,12 @@ async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка выбора типа рассылки"""
     choice = update.message.text
-    logging.info(f"Выбран тип рассылки: {choice}")
+    logging.info("Выбран тип рассылки: %s", choice)
     
     if choice == "❌ Отмена":
         await update.message.reply_text(
             "❌ Рассылка отменена",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=REMOVE_KEYBOARD
         )
         return ConversationHandler.END
     
@@ -369,7 +636,7 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "✍️ <b>Текстовая рассылка</b>\n\n"
             "Введите текст для рассылки:",
-            reply_markup=ReplyKeyboardRemove(),
+            reply_markup=REMOVE_KEYBOARD,
             parse_mode="HTML"
         )
         return BROADCAST_PHOTO
@@ -379,7 +646,7 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "🖼️ <b>Рассылка с фото</b>\n\n"
             "Отправьте фото для рассылки:",
-            reply_markup=ReplyKeyboardRemove(),
+            reply_markup=REMOVE_KEYBOARD,
             parse_mode="HTML"
         )
         return BROADCAST_PHOTO
@@ -391,18 +658,17 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def broadcast_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фото и текста для рассылки"""
     user = update.effective_user
-    if str(user.id) != ADMIN_CHAT_ID:
+    if user.id != ADMIN_CHAT_ID_INT:
         return ConversationHandler.END
 
     broadcast_type = context.user_data.get('broadcast_type', 'text')
-    logging.info(f"Обработка рассылки типа: {broadcast_type}")
+    logging.info("Обработка рассылки типа: %s", broadcast_type)
     
     try:
         # Если это фото и мы ожидаем фото
         if broadcast_type == 'photo' and update.message.photo:
             # Сохраняем фото
-            photo_file = await update.message.photo[-1].get_file()
-            context.user_data['broadcast_photo'] = photo_file.file_id
+            context.user_data['broadcast_photo'] = update.message.photo[-1].file_id
             context.user_data['photo_received'] = True
             
             await update.message.reply_text(
@@ -429,7 +695,7 @@ async def broadcast_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return BROADCAST_PHOTO
     
     except Exception as e:
-        logging.error(f"❌ Ошибка в процессе рассылки: {e}")
+        logging.error("❌ Ошибка в процессе рассылки: %s", e)
         await update.message.reply_text("❌ Произошла ошибка. Попробуйте снова.")
         return ConversationHandler.END
     
@@ -442,12 +708,7 @@ async def show_broadcast_preview(update: Update, context: ContextTypes.DEFAULT_T
     broadcast_text = context.user_data.get('broadcast_text', '')
     broadcast_photo = context.user_data.get('broadcast_photo', None)
     
-    user_count = len(user_manager.get_all_users())
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Начать рассылку", callback_data="confirm_broadcast")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_broadcast")]
-    ])
-    
+    user_count = user_manager.get_stats()
     preview_text = (
         f"📢 <b>Предпросмотр рассылки</b>\n\n"
         f"Текст: {broadcast_text}\n"
@@ -461,20 +722,20 @@ async def show_broadcast_preview(update: Update, context: ContextTypes.DEFAULT_T
             await update.message.reply_photo(
                 photo=broadcast_photo,
                 caption=preview_text,
-                reply_markup=keyboard,
+                reply_markup=BROADCAST_CONFIRM_KEYBOARD,
                 parse_mode="HTML"
             )
         else:
             await update.message.reply_text(
                 preview_text,
-                reply_markup=keyboard,
+                reply_markup=BROADCAST_CONFIRM_KEYBOARD,
                 parse_mode="HTML"
             )
         
         return ConversationHandler.END
         
     except Exception as e:
-        logging.error(f"❌ Ошибка показа предпросмотра: {e}")
+        logging.error("❌ Ошибка показа предпросмотра: %s", e)
         await update.message.reply_text("❌ Ошибка при создании предпросмотра.")
         return ConversationHandler.END
 
@@ -516,7 +777,11 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
     
-    for i, user_id in enumerate(users, 1):
+    sent_count = 0
+    last_progress_update = time.monotonic()
+    
+    async def send_one(user_id):
+        nonlocal success_count, fail_count, sent_count, last_progress_update
         try:
             if broadcast_type == 'photo' and broadcast_photo:
                 await context.bot.send_photo(
@@ -532,25 +797,38 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode="HTML"
                 )
             success_count += 1
-            
-            # Обновляем статистику каждые 10 сообщений
-            if i % 10 == 0 or i == total_users:
+        except Exception as e:
+            fail_count += 1
+            logging.error("❌ Ошибка отправки пользователю %s: %s", user_id, e)
+        sent_count += 1
+        
+        # Обновляем статистику не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд,
+        # чтобы не расходовать лимит исходящих сообщений
+        now = time.monotonic()
+        if now - last_progress_update >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress_update = now
+            try:
                 await context.bot.edit_message_text(
                     chat_id=ADMIN_CHAT_ID,
                     message_id=progress_message.message_id,
                     text=f"📊 <b>Статистика рассылки</b>\n\n"
-                         f"▪️ Отправлено: {i}/{total_users}\n"
+                         f"▪️ Отправлено: {sent_count}/{total_users}\n"
                          f"▪️ Успешно: {success_count}\n"
                          f"▪️ Ошибок: {fail_count}",
                     parse_mode="HTML"
                 )
-            
-            # Задержка чтобы не превысить лимиты Telegram
-            await asyncio.sleep(0.1)
-            
-        except Exception as e:
-            fail_count += 1
-            logging.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+            except Exception as e:
+                logging.warning("⚠️ Не удалось обновить статистику рассылки: %s", e)
+    
+    # Фиксированный пул отправителей разбирает общий итератор получателей,
+    # вместо создания отдельной задачи на каждого пользователя
+    recipients = iter(users)
+    
+    async def sender():
+        for user_id in recipients:
+            await send_one(user_id)
+    
+    await asyncio.gather(*(sender() for _ in range(BROADCAST_CONCURRENCY)))
     
     # Финальная статистика
     await context.bot.edit_message_text(
@@ -572,13 +850,13 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена рассылки"""
     user = update.effective_user
-    if str(user.id) != ADMIN_CHAT_ID:
+    if user.id != ADMIN_CHAT_ID_INT:
         return ConversationHandler.END
     
     context.user_data.clear()
     await update.message.reply_text(
         "❌ Рассылка отменена",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
     return ConversationHandler.END
 
@@ -589,8 +867,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Проверяем, не регистрировался ли пользователь ранее
-    if user_manager.is_user_registered(user.id):
-        existing_coupon = user_manager.get_user_coupon(user.id)
+    is_registered, existing_coupon = user_manager.get_user_state(user.id)
+    if is_registered:
         await update.message.reply_text(
             f"👋 Снова здравствуйте, {user.first_name}!\n\n"
             f"🎫 <b>Ваш купон:</b> <code>{existing_coupon}</code>\n\n"
@@ -600,26 +878,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("📢 Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME[1:]}")],
-        [InlineKeyboardButton("✅ Я подписался", callback_data="check_subscription")]
-    ])
-    
-    caption = (
-        "🛠️ Добро пожаловать в <b>P.I.T Store Оренбург</b>!\n\n"
-        "🎁 <b>Получите специальный купон наааахуй</b>\n\n"
-        "Для участия в акции необходимо:\n"
-        "1️⃣ Подписаться на наш канал\n"
-        "2️⃣ Поделиться номером телефона\n\n"
-        "После этого вы получите персональный купон для использования в нашем магазине!"
-    )
-    
     await send_photo_with_caption(
         update.effective_chat.id,
         context,
         WELCOME_IMAGE,
-        caption,
-        keyboard
+        WELCOME_CAPTION,
+        SUBSCRIBE_KEYBOARD
     )
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -630,8 +894,8 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = query.from_user
     
     # Проверяем, не регистрировался ли пользователь ранее
-    if user_manager.is_user_registered(user.id):
-        existing_coupon = user_manager.get_user_coupon(user.id)
+    is_registered, existing_coupon = user_manager.get_user_state(user.id)
+    if is_registered:
         await query.edit_message_caption(
             caption=f"❌ Вы уже участвовали в акции!\n\nВаш купон: <b>{existing_coupon}</b>",
             parse_mode="HTML"  # Добавляем parse_mode
@@ -639,18 +903,9 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     try:
-        user_channel_status = await context.bot.get_chat_member(
-            chat_id=CHANNEL_USERNAME,
-            user_id=user.id
-        )
+        user_channel_status = await get_subscription_status(context.bot, user.id)
         
-        if user_channel_status.status in ["member", "administrator", "creator"]:
-            keyboard = ReplyKeyboardMarkup(
-                [[KeyboardButton("📞 Поделиться номером", request_contact=True)]],
-                resize_keyboard=True,
-                one_time_keyboard=True
-            )
-            
+        if user_channel_status in SUBSCRIBED_STATUSES:
             await query.edit_message_caption(
                 caption="✅ <b>Отлично! Вы подписаны на канал!</b>\n\nТеперь поделитесь своим номером телефона с помощью кнопки ниже 👇",
                 parse_mode="HTML"  # Добавляем parse_mode
@@ -659,7 +914,7 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Нажмите на кнопку ниже, чтобы поделиться номером телефона:",
-                reply_markup=keyboard
+                reply_markup=CONTACT_KEYBOARD
             )
         else:
             await query.edit_message_caption(
@@ -668,7 +923,7 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             
     except Exception as e:
-        logging.error(f"❌ Ошибка проверки подписки: {e}")
+        logging.error("❌ Ошибка проверки подписки: %s", e)
         await query.edit_message_caption(
             caption="⚠️ <b>Произошла ошибка при проверке подписки.</b>\n\nПожалуйста, попробуйте позже.",
             parse_mode="HTML"  # Добавляем parse_mode
@@ -679,17 +934,6 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     contact = update.message.contact
     user = update.message.from_user
     
-    # Проверяем, не регистрировался ли пользователь ранее
-    if user_manager.is_user_registered(user.id):
-        existing_coupon = user_manager.get_user_coupon(user.id)
-        await update.message.reply_text(
-            f"❌ Вы уже участвовали в акции!\n\n"
-            f"Ваш купон: <b>{existing_coupon}</b>\n\n"
-            f"Один участник = один купон 🎫",
-            parse_mode="HTML"
-        )
-        return
-    
     if contact.user_id == user.id:
         # Форматирование номера телефона
         phone_number = contact.phone_number
@@ -709,60 +953,58 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'coupon': coupon_code
         }
         
-        local_registration = user_manager.register_user(user_data)
+        # Проверка и регистрация одной операцией: если пользователь уже участвовал,
+        # получаем его сохраненный купон
+        is_new_user, existing_coupon = user_manager.register_user(user_data)
+        if not is_new_user and existing_coupon is None:
+            await update.message.reply_text(
+                "❌ Этот номер телефона уже участвовал в акции.\n\n"
+                "Один участник = один купон 🎫"
+            )
+            return
+        if not is_new_user:
+            await update.message.reply_text(
+                f"❌ Вы уже участвовали в акции!\n\n"
+                f"Ваш купон: <b>{existing_coupon}</b>\n\n"
+                f"Один участник = один купон 🎫",
+                parse_mode="HTML"
+            )
+            return
         
         # Сохранение в Google Sheets
         sheets_success = gsheets_manager.add_lead(user_data)
         
-        if local_registration:
-            # Сообщение с купоном
-            caption = (
-                "🎉 <b>Благодарим за участие!</b>\n\n"
-                f"🏷️ <b>Ваш купон на штучку дрючку:</b> <code>{coupon_code}</code>\n\n"
-                "🎁 <b>Что вы получаете:</b>\n"
-                "• Скидку 100% на любой инструмент\n"
-                "• Подарочный набор расходных материалов\n"
-                "• Бесплатную консультацию Коли\n\n"
-                "🏪 <b>Адрес магазина:</b>\n"
-                "г. Оренбург, ул. Монтажников 37/3\n\n"
-                "📞 <b>Телефон для связи:</b> +7 (495) 123-45-67\n\n"
-                "<i>Купон действует в течение 15 дней</i>"
-            )
-            
-            await send_photo_with_caption(
-                update.effective_chat.id,
-                context,
-                COUPON_IMAGE,
-                caption
-            )
-            
-            # Уведомление для администратора
-            admin_message = (
-                "📱 <b>Новый лид!</b>\n"
-                f"👤 Имя: {contact.first_name}\n"
-                f"📞 Телефон: {phone_number}\n"
-                f"🔗 Username: @{user.username}\n" if user.username else "🔗 Username: Не указан\n"
-                f"🆔 User ID: {user.id}\n"
-                f"🏷️ Купон: {coupon_code}\n"
-                f"💾 В таблицу: {'✅' if sheets_success else '❌'}\n"
-                f"📊 Всего участников: {user_manager.get_stats()}"
-            )
-            
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=admin_message,
-                parse_mode="HTML"
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Произошла ошибка при регистрации. Пожалуйста, попробуйте позже."
-            )
+        # Сообщение с купоном
+        await send_photo_with_caption(
+            update.effective_chat.id,
+            context,
+            COUPON_IMAGE,
+            COUPON_CAPTION.format(coupon=coupon_code)
+        )
+        
+        # Уведомление для администратора
+        admin_message = "\n".join([
+            "📱 <b>Новый лид!</b>",
+            f"👤 Имя: {contact.first_name}",
+            f"📞 Телефон: {phone_number}",
+            f"🔗 Username: @{user.username}" if user.username else "🔗 Username: Не указан",
+            f"🆔 User ID: {user.id}",
+            f"🏷️ Купон: {coupon_code}",
+            f"💾 В очередь таблицы: {'✅' if sheets_success else '❌'}",
+            f"📊 Всего участников: {user_manager.get_stats()}"
+        ])
+        
+        await context.bot.send_message(
+            chat_id=ADMIN_CHAT_ID,
+            text=admin_message,
+            parse_mode="HTML"
+        )
     else:
         await update.message.reply_text("❌ Пожалуйста, поделитесь своим номером телефона.")
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика для администратора"""
-    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+    if update.effective_user.id != ADMIN_CHAT_ID_INT:
         await update.message.reply_text("❌ Эта команда только для администратора")
         return
     
@@ -788,7 +1030,169 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
-    logging.error(f"❌ Ошибка: {context.error}")
+    logging.error("❌ Ошибка: %s", context.error)
+
+# ConversationHandler рассылки рассчитан на последовательную обработку обновлений
+# одного пользователя, поэтому обычный concurrent_updates для него не подходит
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных чатов обрабатываются параллельно, одного чата - по очереди"""
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [блокировка, число ожидающих ее обновлений]
+        self._chat_locks = {}
+    
+    async def process_update(self, update, coroutine):
+        """Обработка обновления под блокировкой его чата.
+        
+        Блокировка чата берется раньше общего семафора, чтобы обновления,
+        ждущие занятый чат, не занимали слоты остальных чатов.
+        """
+        chat_id = None
+        if isinstance(update, Update):
+            if update.effective_chat:
+                chat_id = update.effective_chat.id
+            elif update.effective_user:
+                chat_id = update.effective_user.id
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+    
+    async def do_process_update(self, update, coroutine):
+        """Обработка обновления после получения слота семафора"""
+        await coroutine
+    
+    async def initialize(self):
+        """Инициализация не требуется"""
+    
+    async def shutdown(self):
+        """Освобождение ресурсов не требуется"""
+
+async def upload_images(bot):
+    """Однократная загрузка изображений в Telegram для повторной отправки по file_id"""
+    for image_path in (WELCOME_IMAGE, COUPON_IMAGE):
+        if image_path not in IMAGES:
+            logging.warning("⚠️ Изображение не найдено: %s", image_path)
+            continue
+        try:
+            message = await bot.send_photo(
+                chat_id=ADMIN_CHAT_ID,
+                photo=IMAGES[image_path],
+                disable_notification=True
+            )
+            FILE_IDS[image_path] = message.photo[-1].file_id
+            await message.delete()
+            logging.info("✅ Изображение загружено в Telegram: %s", image_path)
+        except Exception as e:
+            logging.error("❌ Ошибка загрузки изображения %s: %s", image_path, e)
+
+async def flush_buffers():
+    """Запись буферов новых пользователей в SQLite и Google Sheets"""
+    await run_db(user_manager.flush_pending)
+    await flush_sheets()
+
+async def flush_sheets(bot=None):
+    """Запись очереди лидов в Google Sheets; незаписанные строки сохраняются в БД.
+    
+    Если передан bot, администратор получает уведомление о строках, отложенных для повторной записи.
+    """
+    failed_rows = await gsheets_manager.flush()
+    if failed_rows:
+        await run_db(user_manager.save_outbox_rows, failed_rows)
+        if bot is not None:
+            try:
+                await bot.send_message(
+                    chat_id=ADMIN_CHAT_ID,
+                    text=f"⚠️ Не удалось записать в таблицу лидов: {len(failed_rows)}. "
+                         f"Строки сохранены для повторной попытки."
+                )
+            except Exception as e:
+                logging.error("❌ Ошибка уведомления администратора: %s", e)
+
+async def retry_outbox():
+    """Повторная запись в таблицу отложенных строк"""
+    if not gsheets_manager.is_connected:
+        return
+    entries = await run_db(user_manager.get_outbox_rows, SHEETS_BATCH_SIZE)
+    if entries and await gsheets_manager.write_rows([row for _, row in entries]):
+        await run_db(user_manager.delete_outbox_rows, [row_id for row_id, _ in entries])
+
+async def flush_worker(stop_event):
+    """Фоновая задача: периодическая запись новых пользователей в SQLite до установки stop_event"""
+    last_checkpoint = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await run_db(user_manager.flush_pending)
+        
+        if time.monotonic() - last_checkpoint >= WAL_CHECKPOINT_INTERVAL:
+            last_checkpoint = time.monotonic()
+            await run_db(user_manager.checkpoint)
+
+async def sheets_worker(stop_event, bot):
+    """Фоновая задача: периодическая запись в Google Sheets до установки stop_event.
+    
+    Работает отдельно от flush_worker, чтобы медленная запись в таблицу
+    не задерживала сохранение пользователей в SQLite.
+    """
+    last_outbox_retry = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=SHEETS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await gsheets_manager.refresh_token_if_needed()
+        await flush_sheets(bot)
+        
+        if time.monotonic() - last_outbox_retry >= SHEETS_OUTBOX_RETRY_INTERVAL:
+            last_outbox_retry = time.monotonic()
+            await retry_outbox()
+
+async def resolve_channel_id(bot):
+    """Определение числового ID канала по CHANNEL_USERNAME"""
+    global CHANNEL_ID
+    try:
+        chat = await bot.get_chat(CHANNEL_USERNAME)
+        CHANNEL_ID = chat.id
+        logging.info("✅ ID канала %s: %s", CHANNEL_USERNAME, CHANNEL_ID)
+    except Exception as e:
+        logging.error("❌ Не удалось получить ID канала %s: %s", CHANNEL_USERNAME, e)
+
+async def post_init(application):
+    """Запуск фоновых задач после инициализации приложения"""
+    await resolve_channel_id(application.bot)
+    await upload_images(application.bot)
+    stop_event = asyncio.Event()
+    application.bot_data['flush_stop'] = stop_event
+    application.bot_data['flush_workers'] = [
+        asyncio.create_task(flush_worker(stop_event)),
+        asyncio.create_task(sheets_worker(stop_event, application.bot))
+    ]
+
+async def post_stop(application):
+    """Остановка фоновых задач, пока бот еще может отправлять сообщения"""
+    workers = application.bot_data.pop('flush_workers', None)
+    if workers:
+        # Не отменяем задачи, а даем им закончить текущую запись,
+        # иначе пакет, ожидающий повтора, не попадет ни в таблицу, ни в БД
+        application.bot_data.pop('flush_stop').set()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+async def post_shutdown(application):
+    """Запись несохраненных данных после остановки бота"""
+    await flush_buffers()
+    db_executor.shutdown(wait=True)
 
 def main():
     """Основная функция запуска бота"""
@@ -797,11 +1201,40 @@ def main():
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     
     if missing_vars:
-        logging.error(f"❌ Отсутствуют обязательные переменные: {', '.join(missing_vars)}")
+        logging.error("❌ Отсутствуют обязательные переменные: %s", ', '.join(missing_vars))
         return
     
+    # HTTP/2 с общим пулом соединений для запросов к Bot API;
+    # long polling держит соединение открытым, поэтому для него отдельный клиент
+    request = HTTPXRequest(
+        http_version="2",
+        connection_pool_size=64,
+        connect_timeout=5,
+        read_timeout=20
+    )
+    get_updates_request = HTTPXRequest(http_version="2", connect_timeout=5)
+    
     # Создаем приложение
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(PerChatUpdateProcessor(256))
+        # Запас до предела Telegram в 30 сообщений/с; при RetryAfter запрос
+        # повторяется после указанной паузы, а не считается ошибкой отправки
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=25,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3
+        ))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Обработчик рассылки
     broadcast_conv = ConversationHandler(